@@ -13,33 +13,245 @@ import argparse
 import torch
 import librosa as li
 import numpy as np
+import soundfile as sf
 from tqdm import tqdm
 import os
-import json
 
-# For PCA and T-SNE:
-from sklearn.decomposition import PCA
-from sklearn.manifold import TSNE
+# For fast JSON output with numpy support (make sure to install: pip install orjson)
+import orjson
+
+# For PCA:
+from sklearn.decomposition import IncrementalPCA
+
+# For T-SNE (make sure to install: pip install openTSNE)
+from openTSNE import TSNE
 
 # For UMAP (make sure to install: pip install umap-learn)
 from umap import UMAP
 
+# Numba is installed alongside umap-learn
+from numba import njit, prange
+
 # For OSC functionality (make sure to install: pip install python-osc)
 from pythonosc import dispatcher
 from pythonosc import osc_server
 from pythonosc import udp_client
 import threading
+import queue
+import contextlib
 import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+# Loaded RAVE models keyed by (model_path, mtime) so they are reused across OSC requests,
+# most recently used last; only the last MAX_CACHED_MODELS stay on the device
+_MODEL_CACHE = OrderedDict()
+MAX_CACHED_MODELS = 2
+_MODEL_CACHE_LOCK = threading.Lock()
+
+# Length of the silent signal used to warm up a model and probe its latent size
+PROBE_SAMPLES = 2048
+
+# OSC requests are queued and run one at a time so concurrent requests don't compete for the GPU
+_gpu_jobs = queue.Queue()
+
+@njit(parallel=True, fastmath=True)
+def scale_inplace(a, target):
+    """Scale a 2D array in place so its largest absolute value equals target."""
+    max_val = 0.0
+    for i in prange(a.shape[0]):
+        for j in range(a.shape[1]):
+            max_val = max(max_val, abs(a[i, j]))
+    if max_val != 0:
+        scale = target / max_val
+        for i in prange(a.shape[0]):
+            for j in range(a.shape[1]):
+                a[i, j] *= scale
+
+# Compile for both float widths at import so OSC requests don't pay the JIT cost
+scale_inplace(np.zeros((2, 2), dtype=np.float32), 5.0)
+scale_inplace(np.zeros((2, 2), dtype=np.float64), 5.0)
+
+def pick_device():
+    """Pick the fastest available device: CUDA, then MPS, then CPU."""
+    if torch.cuda.is_available():
+        return torch.device("cuda")
+    if torch.backends.mps.is_available():
+        return torch.device("mps")
+    return torch.device("cpu")
+
+def autocast(device):
+    """Half-precision autocast context for encoding; a no-op on CPU or where the device has no autocast."""
+    if device.type == "cpu":
+        return contextlib.nullcontext()
+    try:
+        return torch.autocast(device_type=device.type, dtype=torch.float16)
+    except RuntimeError:
+        # MPS autocast only exists in newer torch releases
+        return contextlib.nullcontext()
+
+def load_model(model_path, device):
+    """Load, freeze and warm up a RAVE model, or return it from the cache if already loaded.
+
+    Returns a dict with the scripted "model", its "latent_dim" and its encoder "ratio"
+    (samples per latent frame, or None if the model doesn't report it).
+    """
+    key = (model_path, os.path.getmtime(model_path))
+    with _MODEL_CACHE_LOCK:
+        entry = _MODEL_CACHE.get(key)
+        if entry is not None:
+            _MODEL_CACHE.move_to_end(key)
+            return entry
+
+        print(f"Loading RAVE model from {model_path}...")
+        rave = torch.jit.load(model_path).to(device)
+        rave.eval()
+        print(f"Encoding on {next(rave.parameters()).device}")
+
+        # Exported RAVE models describe their encoder as [in_channels, in_ratio, latent_size, ratio]
+        ratio = int(rave.encode_params[3]) if hasattr(rave, "encode_params") else None
+
+        # Freezing inlines the weights; keep encode since it isn't reachable from forward
+        try:
+            rave = torch.jit.freeze(rave, preserved_attrs=["encode"])
+        except Exception as e:
+            print(f"Could not freeze model, using it unfrozen: {str(e)}")
+
+        # Run one short encode so kernel compilation happens now rather than on the first request
+        with torch.inference_mode(), autocast(device):
+            z = rave.encode(torch.zeros(1, 1, max(PROBE_SAMPLES, ratio or 0), device=device))
+        latent_dim = z.shape[1]  # The latent dimension is the second dimension
+
+        # Drop entries for older versions of the same model file, then the least recently used ones
+        for cached_key in [k for k in _MODEL_CACHE if k[0] == model_path]:
+            del _MODEL_CACHE[cached_key]
+        while len(_MODEL_CACHE) >= MAX_CACHED_MODELS:
+            _MODEL_CACHE.popitem(last=False)
+        entry = {"model": rave, "latent_dim": latent_dim, "ratio": ratio}
+        _MODEL_CACHE[key] = entry
+        return entry
+
+def load_audio(audio_file, sr=48000):
+    """Load a .wav file as mono float32, resampling only when the file rate differs."""
+    x, file_sr = sf.read(audio_file, dtype='float32')
+    if x.ndim > 1:
+        x = x.mean(axis=1)
+    if file_sr != sr:
+        x = li.resample(x, orig_sr=file_sr, target_sr=sr)
+    return x
+
+def audio_length(audio_file, sr=48000):
+    """Number of samples load_audio() will return for a file, read from its header without decoding."""
+    info = sf.info(audio_file)
+    if info.samplerate == sr:
+        return info.frames
+    # Same expression librosa.resample uses for the output length
+    return int(np.ceil(info.frames * (float(sr) / info.samplerate)))
+
+def collate_audio(signals, pin_memory=False):
+    """Zero-pad 1D signals into a (B, 1, T_max) batch; returns the batch and the original lengths."""
+    lengths = torch.tensor([len(x) for x in signals])
+    x = np.zeros((len(signals), 1, max(int(lengths.max()), 1)), dtype=np.float32)
+    for i, signal in enumerate(signals):
+        x[i, 0, :len(signal)] = signal
+    x = torch.from_numpy(x)
+    if pin_memory:
+        # Page-locked host memory lets the upload to the GPU run asynchronously
+        x, lengths = x.pin_memory(), lengths.pin_memory()
+    return x, lengths
+
+def iter_audio_batches(audio_files, sr=48000, batch_size=8, prefetch=2, pin_memory=False):
+    """Yield padded audio batches, decoding the next `prefetch` batches on a thread pool meanwhile."""
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+        pending = deque()
+        for start in range(0, len(audio_files), batch_size):
+            batch = audio_files[start:start + batch_size]
+            pending.append([pool.submit(load_audio, f, sr) for f in batch])
+            if len(pending) > prefetch:
+                yield collate_audio([f.result() for f in pending.popleft()], pin_memory)
+        while pending:
+            yield collate_audio([f.result() for f in pending.popleft()], pin_memory)
+
+def encode_batches(model, batches, device, batch_size, max_samples):
+    """Encode padded (x, lengths) batches and yield their masked mean latents as (B, n_dimensions) arrays.
+
+    On a GPU, batches are copied into a device buffer sized for `batch_size` clips of `max_samples`
+    that is allocated once and reused. On CUDA two buffers are used alternately and each upload
+    runs on a separate copy stream so it overlaps with the previous batch's encode, and a batch's
+    means are only read back once the next batch has been queued.
+    """
+    rave = model["model"]
+    copy_stream = torch.cuda.Stream(device) if device.type == "cuda" else None
+    num_buffers = 0 if device.type == "cpu" else 2 if copy_stream is not None else 1
+    buffers = [torch.empty(batch_size * max_samples, device=device) for _ in range(num_buffers)]
+    buffer_free = [None] * num_buffers  # CUDA events marking when each buffer's last encode finished
+    in_flight = None
+
+    for i, (x, lengths) in enumerate(batches):
+        # Clips are zero-padded to the longest one in the batch: (B, 1, T_max)
+        t_max = x.shape[-1]
+        k = i % num_buffers if num_buffers else None
+        target = None
+        if k is not None and x.numel() <= buffers[k].numel():
+            target = buffers[k][:x.numel()].view(x.shape)
+
+        if target is not None and copy_stream is not None:
+            with torch.cuda.stream(copy_stream):
+                if buffer_free[k] is not None:
+                    copy_stream.wait_event(buffer_free[k])
+                x = target.copy_(x, non_blocking=True)
+                lengths = lengths.to(device, non_blocking=True)
+            compute_stream = torch.cuda.current_stream(device)
+            compute_stream.wait_stream(copy_stream)
+            lengths.record_stream(compute_stream)
+        elif target is not None:
+            x, lengths = target.copy_(x), lengths.to(device)
+        else:
+            # No buffer on CPU, or a batch longer than probed: copy synchronously on the compute stream
+            x, lengths = x.to(device), lengths.to(device)
+
+        # Encode the batch into latent representation using the RAVE model.
+        with torch.inference_mode():
+            with autocast(device):
+                z = rave.encode(x)  # Expected shape: (B, n_dimensions, encoded_sample_length)
+            z = z.float()
+
+            # Convert sample lengths to encoded frames so padding is left out of the mean
+            hop = model["ratio"] or t_max / z.shape[-1]
+            frames = torch.ceil(lengths.float() / hop).clamp(1, z.shape[-1])
+            mask = torch.arange(z.shape[-1], device=device)[None, :] < frames[:, None]
+
+            # Average across valid time steps on the device so only (B, n_dimensions) is copied back
+            z_mean = (z * mask[:, None, :]).sum(dim=-1) / frames[:, None]
+            z_mean = z_mean.to("cpu", non_blocking=copy_stream is not None)
 
-def process_audio_files(model_path, audio_dir, output_json=None, n_components=2, sr=48000, method="pca", skip_dim_reduction=False, osc_client=None, osc_address=None):
+        done = None
+        if copy_stream is not None:
+            done = torch.cuda.Event()
+            done.record()
+            if target is not None:
+                buffer_free[k] = done
+
+        if in_flight is not None:
+            yield _finish_batch(*in_flight)
+        in_flight = (z_mean, done)
+
+    if in_flight is not None:
+        yield _finish_batch(*in_flight)
+
+def _finish_batch(z_mean, done):
+    """Wait for an asynchronous readback to land and return it as a numpy array."""
+    if done is not None:
+        done.synchronize()
+    return z_mean.numpy()
+
+def process_audio_files(model_path, audio_dir, output_json=None, n_components=2, sr=48000, method="pca", skip_dim_reduction=False, osc_client=None, osc_address=None, batch_size=8):
     """Process audio files using the RAVE model and dimensionality reduction."""
     # Set device: GPU if available, otherwise CPU.
-    device = torch.device("mps" if torch.cuda.is_available() else "cpu")
+    device = pick_device()
 
     # Load the pre-trained RAVE model.
-    print(f"Loading RAVE model from {model_path}...")
-    rave = torch.jit.load(model_path).to(device)
-    rave.eval()
+    model = load_model(model_path, device)
 
     # List all .wav files in the specified audio directory.
     audio_files = [
@@ -51,89 +263,91 @@ def process_audio_files(model_path, audio_dir, output_json=None, n_components=2,
         print(f"No audio files found in directory: {audio_dir}")
         return None
 
-    # Dictionary to store latent vectors for each file
-    latent_data = {}
-    latent_vectors_all = []
-    num_dimensions = None
+    # Read clip lengths from the file headers to size the device batch buffers
+    lengths = np.array([audio_length(f, sr=sr) for f in audio_files])
+    max_samples = max(int(lengths.max()), 1)
+
+    # Encode files shortest first so each batch holds clips of similar length and little padding;
+    # order[i] is the position in audio_files of the i-th file encoded
+    order = np.argsort(lengths, kind="stable")
+
+    # Matrix of mean latent vectors (one row per file)
+    num_dimensions = model["latent_dim"]
+    latent_matrix = np.empty((len(audio_files), num_dimensions), dtype=np.float32)
+
+    # Get filenames without extension for use as keys
+    file_keys = [os.path.splitext(os.path.basename(f))[0] for f in audio_files]
+
+    # PCA is fitted incrementally while encoding; rows order[:fitted] have been fed to it
+    ipca = None
+    if not skip_dim_reduction and method not in ("tsne", "umap"):
+        ipca = IncrementalPCA(n_components=2, batch_size=256)
+    fitted = 0
 
     print("Encoding audio files to latent space...")
-    for audio_file in tqdm(audio_files, desc="Processing audio files"):
-        # Get filename without extension for use as key
-        file_key = os.path.splitext(os.path.basename(audio_file))[0]
-        
-        # Load audio file using librosa.
-        x, _ = li.load(audio_file, sr=sr, mono=True)
-        # Reshape to (1, 1, samples) and move to the device.
-        x = torch.from_numpy(x).reshape(1, 1, -1).float().to(device)
-
-        # Encode the audio into latent representation using the RAVE model.
-        with torch.no_grad():
-            z = rave.encode(x)  # Expected shape: (1, n_dimensions, encoded_sample_length)
-            z = z.cpu().numpy().squeeze()  # Remove batch dimension: (n_dimensions, encoded_sample_length)
-            
-            # Check dimension of z and handle accordingly
-            if z.ndim == 1:
-                # Only one dimension, so we have a single vector, no need to average
-                z_mean = z
-                # If this is the first file, use z's length as num_dimensions
-                if num_dimensions is None:
-                    num_dimensions = 1
-            else:
-                # Store the number of dimensions (for the 'cols' field in output JSON)
-                if num_dimensions is None:
-                    num_dimensions = z.shape[0]
-                
-                # Calculate the mean latent vector for the file (averaging across time)
-                z_mean = np.mean(z, axis=1)
-            
-            # Store the mean latent vector in the dictionary with filename as key
-            latent_data[file_key] = z_mean.tolist()
-            latent_vectors_all.append(z_mean)
-
-    # Prepare output data in the format expected by fluid.dataset~
+    start = 0
+    with tqdm(total=len(audio_files), desc="Processing audio files") as progress:
+        # Files are decoded on worker threads while the previous batch is being encoded
+        sorted_files = [audio_files[i] for i in order]
+        batches = iter_audio_batches(sorted_files, sr=sr, batch_size=batch_size, pin_memory=device.type == "cuda")
+        buffer_rows = min(batch_size, len(audio_files))
+        for z_mean in encode_batches(model, batches, device, buffer_rows, max_samples):
+            # Rows are written back to their original positions so the output keeps the file order
+            latent_matrix[order[start:start + len(z_mean)]] = z_mean
+            start += len(z_mean)
+
+            # Fit full chunks as they arrive, leaving at least n_components rows for the final fit
+            while ipca is not None and start - fitted >= ipca.batch_size + ipca.n_components:
+                ipca.partial_fit(latent_matrix[order[fitted:fitted + ipca.batch_size]])
+                fitted += ipca.batch_size
+
+            progress.update(len(z_mean))
+
+    # Return cached device memory, including the batch buffers, to the OS between requests
+    if device.type == "cuda":
+        torch.cuda.empty_cache()
+    elif device.type == "mps":
+        torch.mps.empty_cache()
+
+    # Prepare output data in the format expected by fluid.dataset~, with filenames as keys
     output_data = {
         "cols": num_dimensions,
-        "data": latent_data
+        "data": dict(zip(file_keys, latent_matrix))
     }
 
     # Optionally perform dimensionality reduction and include it in the output
     if not skip_dim_reduction:
-        latent_matrix = np.array(latent_vectors_all)
-        
         # Always use 2 components for dimensionality reduction regardless of user input
         n_components = 2
+
+        # All reducers take contiguous float32 input; this is a no-op for the preallocated matrix
+        latent_matrix = np.ascontiguousarray(latent_matrix, dtype=np.float32)
         
         if method == "tsne":
             print("Performing T-SNE on latent vectors (2 components)...")
-            tsne = TSNE(n_components=n_components, random_state=42)
-            latent_reduced = tsne.fit_transform(latent_matrix)
+            tsne = TSNE(n_components=n_components, n_jobs=-1, random_state=42, negative_gradient_method="fft")
+            latent_reduced = np.asarray(tsne.fit(latent_matrix))
             # Scale T-SNE coordinates
-            max_val = np.abs(latent_reduced).max()
-            if max_val != 0:
-                latent_reduced = latent_reduced * (5.0 / max_val)
-            output_data["reduced_data"] = {}
-            for i, file_key in enumerate(latent_data.keys()):
-                output_data["reduced_data"][file_key] = latent_reduced[i].tolist()
-        
+            scale_inplace(latent_reduced, 5.0)
+
         elif method == "umap":
             print("Performing UMAP on latent vectors (2 components)...")
-            umap_model = UMAP(n_components=n_components, random_state=42)
+            # No random_state: seeding UMAP forces single-threaded nearest-neighbour descent
+            umap_model = UMAP(n_components=n_components, n_jobs=-1, low_memory=False, init="pca", metric="euclidean")
             latent_reduced = umap_model.fit_transform(latent_matrix)
             # Scale UMAP coordinates
-            max_val = np.abs(latent_reduced).max()
-            if max_val != 0:
-                latent_reduced = latent_reduced * (5.0 / max_val)
-            output_data["reduced_data"] = {}
-            for i, file_key in enumerate(latent_data.keys()):
-                output_data["reduced_data"][file_key] = latent_reduced[i].tolist()
-                
+            scale_inplace(latent_reduced, 5.0)
+
         else:  # pca
             print("Performing PCA on latent vectors (2 components)...")
-            pca = PCA(n_components=n_components)
-            latent_reduced = pca.fit_transform(latent_matrix)
-            output_data["reduced_data"] = {}
-            for i, file_key in enumerate(latent_data.keys()):
-                output_data["reduced_data"][file_key] = latent_reduced[i].tolist()
+            if fitted < len(latent_matrix):
+                ipca.partial_fit(latent_matrix[order[fitted:]])
+            latent_reduced = np.concatenate([
+                ipca.transform(latent_matrix[i:i + ipca.batch_size])
+                for i in range(0, len(latent_matrix), ipca.batch_size)
+            ])
+
+        output_data["reduced_data"] = dict(zip(file_keys, latent_reduced))
 
     # Determine the output JSON filename.
     if output_json is None:
@@ -152,8 +366,8 @@ def process_audio_files(model_path, audio_dir, output_json=None, n_components=2,
         output_json = os.path.abspath(output_json)
 
     # Save the output data to a JSON file.
-    with open(output_json, "w") as json_file:
-        json.dump(output_data, json_file, indent=2)
+    with open(output_json, "wb") as json_file:
+        json_file.write(orjson.dumps(output_data, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_INDENT_2))
 
     print(f"Latent mapping data saved to {output_json}")
     
@@ -164,6 +378,10 @@ def process_audio_files(model_path, audio_dir, output_json=None, n_components=2,
     
     return output_json
 
+def _strip_mac(path):
+    """Fix macOS paths that might start with "Macintosh HD:"."""
+    return path.removeprefix("Macintosh HD:")
+
 def handle_process_request(address, *args):
     """Handle OSC message with audio directory and model path."""
     if len(args) < 2:
@@ -171,59 +389,42 @@ def handle_process_request(address, *args):
         return
     
     # Get path arguments and normalize them
-    audio_dir = args[0]
-    model_path = args[1]
-    
-    # Fix macOS paths that might start with "Macintosh HD:"
-    if audio_dir.startswith("Macintosh HD:"):
-        audio_dir = audio_dir.replace("Macintosh HD:", "", 1)
-    if model_path.startswith("Macintosh HD:"):
-        model_path = model_path.replace("Macintosh HD:", "", 1)
+    audio_dir = _strip_mac(args[0])
+    model_path = _strip_mac(args[1])
     
     # Optional arguments
-    output_json = args[2] if len(args) > 2 else None
+    output_json = _strip_mac(args[2]) if len(args) > 2 else None
     method = args[3] if len(args) > 3 else "pca"
     skip_dim_reduction = bool(args[4]) if len(args) > 4 else False
+    batch_size = max(int(args[5]), 1) if len(args) > 5 else default_batch_size
     
     print(f"Processing audio files in {audio_dir} with model {model_path}")
     
-    # Process in a separate thread to not block the OSC server
-    def process_thread():
+    # Queue for the GPU worker to not block the OSC server
+    def process_job():
         output_path = process_audio_files(
             model_path=model_path,
             audio_dir=audio_dir,
             output_json=output_json,
             method=method,
             skip_dim_reduction=skip_dim_reduction,
+            batch_size=batch_size,
             osc_client=osc_client,
             osc_address="/rave/processing/done"
         )
     
-    threading.Thread(target=process_thread).start()
+    _gpu_jobs.put(process_job)
 
 def get_model_dimensions(model_path, osc_client=None, osc_address=None):
     """Load a RAVE model and determine its latent dimensions."""
     try:
-        # Fix macOS paths that might start with "Macintosh HD:"
-        if model_path.startswith("Macintosh HD:"):
-            model_path = model_path.replace("Macintosh HD:", "", 1)
-            
         print(f"Loading model to determine latent dimensions: {model_path}")
         
         # Set device: GPU if available, otherwise CPU
-        device = torch.device("mps" if torch.cuda.is_available() else "cpu")
-        
-        # Load the model
-        rave = torch.jit.load(model_path).to(device)
-        rave.eval()
+        device = pick_device()
         
-        # Create a short test signal to encode
-        test_signal = torch.zeros(1, 1, 48000).float().to(device)  # 1 second of silence at 48kHz
-        
-        # Encode to get dimensions
-        with torch.no_grad():
-            z = rave.encode(test_signal)
-            latent_dim = z.shape[1]  # The latent dimension is the second dimension
+        # Load the model (or reuse it from the cache), which also probes its latent size
+        latent_dim = load_model(model_path, device)["latent_dim"]
         
         print(f"Model has {latent_dim} latent dimensions")
         
@@ -246,18 +447,29 @@ def handle_model_info_request(address, *args):
         print(f"No model path received at {address}")
         return
     
-    model_path = args[0]
+    model_path = _strip_mac(args[0])
     print(f"Received request for model info: {model_path}")
     
-    # Process in a separate thread to not block the OSC server
-    def process_thread():
+    # Queue for the GPU worker to not block the OSC server
+    def process_job():
         get_model_dimensions(
             model_path=model_path,
             osc_client=osc_client,
             osc_address="/rave/model/dimensions"
         )
     
-    threading.Thread(target=process_thread).start()
+    _gpu_jobs.put(process_job)
+
+def gpu_worker():
+    """Run queued OSC jobs one after another on a single thread."""
+    while True:
+        job = _gpu_jobs.get()
+        try:
+            job()
+        except Exception as e:
+            print(f"Error processing request: {str(e)}")
+        finally:
+            _gpu_jobs.task_done()
 
 def main():
     # Set up command-line arguments
@@ -282,6 +494,12 @@ def main():
         default=9002,
         help="Port to send OSC messages (default: 9002)"
     )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=8,
+        help="Number of audio files encoded together on the GPU (default: 8)"
+    )
     args = parser.parse_args()
 
     # Set up OSC dispatcher
@@ -292,13 +510,20 @@ def main():
     # Create OSC client for sending responses
     global osc_client
     osc_client = udp_client.SimpleUDPClient(args.osc_ip, args.osc_out_port)
+
+    # Default batch size for /rave/process requests that don't specify one
+    global default_batch_size
+    default_batch_size = max(args.batch_size, 1)
     
+    # Start the worker that runs queued requests
+    threading.Thread(target=gpu_worker, daemon=True).start()
+
     # Start OSC server
     server = osc_server.ThreadingOSCUDPServer(
         (args.osc_ip, args.osc_in_port), osc_dispatcher)
     
     print(f"Starting OSC server at {args.osc_ip}:{args.osc_in_port}")
-    print(f"Send messages to /rave/process with arguments: [audio_dir] [model_path] [optional: output_json] [optional: method] [optional: skip_dim_reduction]")
+    print(f"Send messages to /rave/process with arguments: [audio_dir] [model_path] [optional: output_json] [optional: method] [optional: skip_dim_reduction] [optional: batch_size]")
     print(f"Send messages to /rave/model/info with argument: [model_path] to get latent dimensions")
     print(f"Responses will be sent to {args.osc_ip}:{args.osc_out_port}")
     